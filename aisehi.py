@@ -1,10 +1,10 @@
 from __future__ import annotations
 
-import re
 from typing import Dict, Tuple
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
 
 
 # ----------------------------
@@ -22,6 +22,43 @@ _MODEL_DISPLAY = {
     "final_smoothed_values": "Final_smoothed_values",
 }
 
+# ----------------------------
+# Helper: month-name lookups used to detect baseline month columns
+# ----------------------------
+_MONTH_ABBR_SET = frozenset({
+    "jan", "feb", "mar", "apr", "may", "jun",
+    "jul", "aug", "sep", "oct", "nov", "dec",
+})
+
+_FULL_TO_ABBREV = {
+    "january": "Jan", "february": "Feb", "march": "Mar", "april": "Apr",
+    "may": "May", "june": "Jun", "july": "Jul", "august": "Aug",
+    "september": "Sep", "october": "Oct", "november": "Nov", "december": "Dec",
+}
+
+
+def _row_nanmean(a: np.ndarray) -> np.ndarray:
+    """Row-wise mean of a 2D float array ignoring NaNs (all-NaN rows -> NaN, no warning)."""
+    valid = ~np.isnan(a)
+    counts = valid.sum(axis=1)
+    sums = np.where(valid, a, 0.0).sum(axis=1)
+    out = np.full(a.shape[0], np.nan)
+    np.divide(sums, counts, out=out, where=counts > 0)
+    return out
+
+
+def _month_year_labels(month: pd.Series) -> np.ndarray:
+    """Mon-YY label per row, formatting each distinct month only once (NaT -> NaN)."""
+    # label by wall-clock month; casting tz-aware values would shift them to UTC first
+    if month.dt.tz is not None:
+        month = month.dt.tz_localize(None)
+    uniq, inv = np.unique(month.to_numpy().astype("datetime64[M]"), return_inverse=True)
+    labels = np.array(
+        [np.nan if np.isnat(u) else pd.Timestamp(u).strftime("%b-%y") for u in uniq],
+        dtype=object,
+    )
+    return labels[inv.ravel()]
+
 
 def process_forecast_results(
     forecast_results: Dict[str, pd.DataFrame]
@@ -33,128 +70,132 @@ def process_forecast_results(
       pivot_smoothed_df:    Year x Month baseline (NO Avg column)
     """
 
-    combined_forecast_df = pd.DataFrame()
+    # Collect per-model frames and concat once (avoids quadratic re-allocation)
+    frames: list[pd.DataFrame] = []
 
     # 1) Combine forecasts from model outputs
     skip_keys = {"train", "test", "debug", "final_smoothed_values"}
+    display_get = _MODEL_DISPLAY.get
     for model_name, df_fc in (forecast_results or {}).items():
-        if model_name in skip_keys:
-            continue
-        if df_fc is None or getattr(df_fc, "empty", True):
+        name = str(model_name).strip()
+        low = name.lower()
+        if low in skip_keys or df_fc is None or df_fc.empty:
             continue
 
-        df_temp = df_fc.copy()
-
-        # Normalize expected columns
+        # Resolve expected columns
         # common patterns: Prophet gives ds/yhat, others may already have Month/Forecast
-        if "ds" in df_temp.columns:
-            df_temp = df_temp.rename(columns={"ds": "Month"})
-        if "yhat" in df_temp.columns:
-            df_temp = df_temp.rename(columns={"yhat": "Forecast"})
+        month_col = "ds" if "ds" in df_fc.columns else "Month"
+        value_col = "yhat" if "yhat" in df_fc.columns else "Forecast"
 
-        if "Month" not in df_temp.columns or "Forecast" not in df_temp.columns:
+        if month_col not in df_fc.columns or value_col not in df_fc.columns:
             # Skip unknown format safely
             continue
 
-        display = _MODEL_DISPLAY.get(str(model_name).strip().lower(), str(model_name).title())
-        df_temp["Model"] = display
+        # display names are trimmed here so the combined frame needs no re-normalization
+        display = display_get(low) or name.title()
 
-        df_temp["Month"] = pd.to_datetime(df_temp["Month"], errors="coerce")
-        df_temp["Forecast"] = pd.to_numeric(df_temp["Forecast"], errors="coerce")
-        df_temp = df_temp.dropna(subset=["Month", "Forecast"])
+        # Coerce the raw arrays and drop unparseable rows before building the small frame
+        months = pd.to_datetime(df_fc[month_col].to_numpy(), errors="coerce")
+        values = np.asarray(pd.to_numeric(df_fc[value_col].to_numpy(), errors="coerce"), dtype=np.float64)
+        ok = ~(months.isna() | np.isnan(values))
+        frames.append(pd.DataFrame({"Model": display, "Month": months[ok], "Forecast": values[ok]}))
 
-        combined_forecast_df = pd.concat(
-            [combined_forecast_df, df_temp[["Model", "Month", "Forecast"]]],
-            ignore_index=True,
-        )
+    # frames are built from arrays (fresh RangeIndex), so a lone frame needs no concat
+    if not frames:
+        combined_forecast_df = pd.DataFrame(columns=["Model", "Month", "Forecast"])
+    elif len(frames) == 1:
+        combined_forecast_df = frames[0]
+    else:
+        combined_forecast_df = pd.concat(frames, ignore_index=True)
 
     wide_forecast_df = pd.DataFrame()
     pivot_smoothed_df = pd.DataFrame()
 
     # 2) Build wide forecast table for display
     if not combined_forecast_df.empty:
-        combined_forecast_df = combined_forecast_df.copy()
+        # create Mon-YY label (strftime ignores the day, so no month-start normalization needed)
+        # per-model frames are already coerced, so this only re-parses on unexpected dtypes
+        if not is_datetime64_any_dtype(combined_forecast_df["Month"]):
+            combined_forecast_df["Month"] = pd.to_datetime(combined_forecast_df["Month"], errors="coerce")
+        combined_forecast_df["Month_Year"] = _month_year_labels(combined_forecast_df["Month"])
 
-        # standardize month to period start + create Mon-YY label
-        combined_forecast_df["Month"] = (
-            pd.to_datetime(combined_forecast_df["Month"], errors="coerce")
-            .dt.to_period("M")
-            .dt.to_timestamp()
-        )
-        combined_forecast_df["Month_Year"] = combined_forecast_df["Month"].dt.strftime("%b-%y")
+        # categorical keys let groupby/unstack hash integer codes instead of strings
+        combined_forecast_df["Model"] = combined_forecast_df["Model"].astype("category")
+        combined_forecast_df["Month_Year"] = combined_forecast_df["Month_Year"].astype("category")
 
-        combined_forecast_df["Model"] = combined_forecast_df["Model"].astype(str).str.strip()
-        combined_forecast_df["Month_Year"] = combined_forecast_df["Month_Year"].astype(str).str.strip()
+        # average duplicates (if any); keys are unique afterwards, so unstack needs no pivot checks
+        forecast_by_key = combined_forecast_df.groupby(["Model", "Month_Year"], observed=True)["Forecast"].mean()
 
-        # average duplicates (if any)
-        combined_forecast_df = (
-            combined_forecast_df.groupby(["Model", "Month_Year"], as_index=False)["Forecast"].mean()
-        )
+        combined_forecast_df = forecast_by_key.reset_index()
+        wide_forecast_df = forecast_by_key.unstack("Month_Year").reset_index()
 
-        wide_forecast_df = (
-            combined_forecast_df.pivot(index="Model", columns="Month_Year", values="Forecast")
-            .reset_index()
-        )
+        # hand plain strings back to callers (they append rows / compare labels)
+        combined_forecast_df["Model"] = combined_forecast_df["Model"].astype(str)
+        combined_forecast_df["Month_Year"] = combined_forecast_df["Month_Year"].astype(str)
+        wide_forecast_df["Model"] = wide_forecast_df["Model"].astype(str)
 
         # Add Avg column (mean across month columns)
         month_cols = [c for c in wide_forecast_df.columns if c not in ("Model", "Avg")]
         if month_cols:
-            wide_forecast_df["Avg"] = wide_forecast_df[month_cols].apply(
-                lambda r: pd.to_numeric(r, errors="coerce").mean(), axis=1
-            )
+            # Forecast is coerced per model, so the pivoted block is already numeric
+            wide_forecast_df["Avg"] = _row_nanmean(wide_forecast_df[month_cols].to_numpy(dtype=np.float64))
 
         # Put Avg right after Model
-        cols = list(wide_forecast_df.columns)
-        if "Avg" in cols:
-            cols = ["Model", "Avg"] + [c for c in cols if c not in ("Model", "Avg")]
-            wide_forecast_df = wide_forecast_df[cols]
+        if "Avg" in wide_forecast_df.columns:
+            other_cols = [c for c in wide_forecast_df.columns if c not in ("Model", "Avg")]
+            wide_forecast_df = wide_forecast_df.reindex(columns=["Model", "Avg", *other_cols])
 
     # 3) Build pivot of final_smoothed_values baseline (Year x Month)
     if isinstance(forecast_results, dict) and "final_smoothed_values" in forecast_results:
         base = forecast_results["final_smoothed_values"]
         if base is not None and not getattr(base, "empty", True):
-            final_smoothed_df = base.copy()
-
-            # Ensure Date exists and is datetime
-            if "Date" in final_smoothed_df.columns:
-                final_smoothed_df["Date"] = pd.to_datetime(final_smoothed_df["Date"], errors="coerce")
-            else:
-                # If Date not present, we can't pivot baseline reliably
-                final_smoothed_df["Date"] = pd.NaT
-
-            if "Final_Smoothed_Value" in final_smoothed_df.columns:
-                final_smoothed_df["Final_Smoothed_Value"] = pd.to_numeric(
-                    final_smoothed_df["Final_Smoothed_Value"], errors="coerce"
-                )
-
-            final_smoothed_df = final_smoothed_df.dropna(subset=["Date", "Final_Smoothed_Value"])
-
-            final_smoothed_df["Year"] = final_smoothed_df["Date"].dt.year.astype(int)
-            final_smoothed_df["Month"] = final_smoothed_df["Date"].dt.strftime("%b")
-
-            pivot_smoothed_df = (
-                final_smoothed_df.pivot(
-                    index="Year",
-                    columns="Month",
-                    values="Final_Smoothed_Value",
+            # Coerce Date/value arrays directly and keep rows where both parse
+            # (if either column is missing we can't pivot baseline reliably)
+            if "Date" in base.columns and "Final_Smoothed_Value" in base.columns:
+                dates = pd.to_datetime(base["Date"].to_numpy(), errors="coerce")
+                values = np.asarray(
+                    pd.to_numeric(base["Final_Smoothed_Value"].to_numpy(), errors="coerce"), dtype=np.float64
                 )
-                .reset_index()
-            )
+            else:
+                dates = pd.DatetimeIndex([])
+                values = np.empty(0)
+            ok = ~(dates.isna() | np.isnan(values))
+            dates, values = dates[ok], values[ok]
+
+            # Scatter into a dense Year x 12 grid, averaging duplicate (Year, Month) rows
+            years = dates.year.to_numpy()
+            months = dates.month.to_numpy() - 1
+            uniq_years, year_idx = np.unique(years, return_inverse=True)
+
+            sums = np.zeros((len(uniq_years), 12))
+            counts = np.zeros((len(uniq_years), 12))
+            np.add.at(sums, (year_idx, months), values)
+            np.add.at(counts, (year_idx, months), 1)
+            grid = np.full((len(uniq_years), 12), np.nan)
+            np.divide(sums, counts, out=grid, where=counts > 0)
 
-            # Reorder months to calendar order (NO Avg column here)
             months_order = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
                             "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-            keep = ["Year"] + [m for m in months_order if m in pivot_smoothed_df.columns]
-            pivot_smoothed_df = pivot_smoothed_df[keep]
+            pivot_smoothed_df = pd.DataFrame(grid, columns=months_order)
+            pivot_smoothed_df.insert(0, "Year", uniq_years.astype(int))
+
+            # Keep calendar order but only months present in the data (NO Avg column here)
+            present = np.unique(months)
+            keep = ["Year"] + [months_order[m] for m in present]
+            pivot_smoothed_df = pivot_smoothed_df.reindex(columns=keep)
 
     return combined_forecast_df, wide_forecast_df, pivot_smoothed_df
 
 
-def fill_final_smoothed_row(wide_df: pd.DataFrame, baseline_df: pd.DataFrame) -> pd.DataFrame:
+def fill_final_smoothed_row(
+    wide_df: pd.DataFrame, baseline_df: pd.DataFrame, copy: bool = True
+) -> pd.DataFrame:
     """
     Fills the 'Final_smoothed_values' row in wide_df using baseline_df (Year x Month).
     This function is robust to the presence/absence of 'Avg' and will NEVER require
     baseline_df to have an 'Avg' column (fixes your melt error).
+    Pass copy=False to fill wide_df in place when the caller owns it; baseline_df is
+    never modified.
     """
 
     if wide_df is None or wide_df.empty or "Model" not in wide_df.columns:
@@ -163,8 +204,10 @@ def fill_final_smoothed_row(wide_df: pd.DataFrame, baseline_df: pd.DataFrame) ->
     if baseline_df is None or baseline_df.empty:
         return wide_df
 
-    wide_df = wide_df.copy()
-    base = baseline_df.copy()
+    if copy:
+        wide_df = wide_df.copy()
+    # only rebound via reset_index/rename below, so no guard copy is needed
+    base = baseline_df
 
     # Find the "final smoothed" row robustly (handles truncations like "Final_smoot")
     model_series = wide_df["Model"].astype(str).str.strip().str.lower()
@@ -182,34 +225,16 @@ def fill_final_smoothed_row(wide_df: pd.DataFrame, baseline_df: pd.DataFrame) ->
         else:
             return wide_df
 
-    # Determine month columns in baseline (explicitly ignore Avg/Model/etc.)
-    full_to_abbrev = {
-        "january": "Jan", "february": "Feb", "march": "Mar", "april": "Apr",
-        "may": "May", "june": "Jun", "july": "Jul", "august": "Aug",
-        "september": "Sep", "october": "Oct", "november": "Nov", "december": "Dec",
-    }
-
-    def is_month_col(col) -> bool:
-        s = str(col).strip()
-        low = s.lower()
-        if low in {"year", "model", "avg", "average", "total"}:
-            return False
-        if re.fullmatch(r"(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)", low):
-            return True
-        if low in full_to_abbrev:
-            return True
-        return False
-
-    month_cols = [c for c in base.columns if is_month_col(c)]
-    if not month_cols:
+    # Determine month columns in baseline (Avg/Model/Year/etc. never match the month sets)
+    # normalize each column name once and reuse it for detection + renaming
+    norm = [(c, str(c).strip().lower()) for c in base.columns]
+    month_norm = [(c, low) for c, low in norm if low in _MONTH_ABBR_SET or low in _FULL_TO_ABBREV]
+    if not month_norm:
         return wide_df
 
     # Normalize full month names -> abbreviations
-    rename = {}
-    for c in month_cols:
-        low = str(c).strip().lower()
-        if low in full_to_abbrev:
-            rename[c] = full_to_abbrev[low]
+    rename = {c: _FULL_TO_ABBREV[low] for c, low in month_norm if low in _FULL_TO_ABBREV}
+    month_cols = [c for c, _ in month_norm]
     if rename:
         base = base.rename(columns=rename)
         month_cols = [rename.get(c, c) for c in month_cols]
@@ -226,32 +251,25 @@ def fill_final_smoothed_row(wide_df: pd.DataFrame, baseline_df: pd.DataFrame) ->
     baseline_melted["Smoothed"] = pd.to_numeric(baseline_melted["Smoothed"], errors="coerce")
     baseline_melted = baseline_melted.dropna(subset=["Smoothed"])
 
-    baseline_melted["Month_Year"] = baseline_melted.apply(
-        lambda r: f"{str(r['Month']).strip().title()[:3]}-{str(int(r['Year']))[-2:]}",
-        axis=1,
-    )
+    base_month = baseline_melted["Month"].astype(str).str.strip().str.title().str.slice(0, 3)
+    year_str = (baseline_melted["Year"].astype(int) % 100).astype(str).str.zfill(2)
+    baseline_melted["Month_Year"] = base_month + "-" + year_str
 
-    baseline_lookup = (
-        baseline_melted.groupby("Month_Year")["Smoothed"]
-        .mean()
-        .to_dict()
-    )
+    # keep your original scaling behavior:
+    # baseline is in percent (e.g., 3.10), wide stores fraction (e.g., 0.031)
+    baseline_lookup = baseline_melted.groupby("Month_Year", sort=False)["Smoothed"].mean() / 100.0
 
-    # Fill wide_df columns that match Month_Year keys
-    for col in wide_df.columns:
-        if col in ("Model",):
-            continue
-        if col in baseline_lookup:
-            # keep your original scaling behavior:
-            # baseline is in percent (e.g., 3.10), wide stores fraction (e.g., 0.031)
-            wide_df.loc[mask, col] = baseline_lookup[col] / 100.0
+    # Fill wide_df columns that match Month_Year keys in one assignment
+    fill_cols = [c for c in wide_df.columns if c != "Model" and c in baseline_lookup.index]
+    if fill_cols:
+        wide_df.loc[mask, fill_cols] = baseline_lookup.reindex(fill_cols).to_numpy()
 
     # Recompute Avg for the final row if Avg column exists
     if "Avg" in wide_df.columns:
         month_cols_in_wide = [c for c in wide_df.columns if c not in ("Model", "Avg")]
         if month_cols_in_wide:
-            wide_df.loc[mask, "Avg"] = wide_df.loc[mask, month_cols_in_wide].apply(
-                lambda r: pd.to_numeric(r, errors="coerce").mean(), axis=1
+            wide_df.loc[mask, "Avg"] = (
+                wide_df.loc[mask, month_cols_in_wide].apply(pd.to_numeric, errors="coerce").mean(axis=1)
             )
 
     return wide_df